@@ -5,22 +5,38 @@
 # Copyright © 2022 R.F. Smith <rsmith@xs4all.nl>
 # SPDX-License-Identifier: MIT
 # Created: 2022-10-10T23:13:41+0200
-# Last modified: 2024-09-15T10:51:42+0200
+# Last modified: 2026-10-15T18:01:41+0200
 
-import glob
+import concurrent.futures as cf
 import hashlib
-import json
+import operator
 import os
+import re
 import sqlite3
 import subprocess as sp
+import sys
+import tarfile
 import time
 
+try:
+    # orjson is considerably faster, but optional.
+    import orjson as json
+except ImportError:
+    import json
+
 # Configuration
 ABI = "FreeBSD:14:amd64"
 REL = "quarterly"
+BASEURL = f"http://pkg.freebsd.org/{ABI}/{REL}/"
 REPO = "repo/"
 PKGDIR = REPO + "All/"  # must end with path separator.
 
+# Splits the file name of a package into name and version.
+PKGRE = re.compile(r"([^/]+)-([^-/]+)\.pkg$")
+
+# Splits a version into runs of digits and other characters.
+VERRE = re.compile(r"(\d+)")
+
 # Colors
 BOLD_WHITE = "\033[1;37m"
 CYAN = "\033[0;36m"
@@ -32,13 +48,40 @@ YELLOW = "\033[0;33m"
 BOLD_YELLOW = "\033[1;33m"
 RESET = "\033[0m"  # No Color
 
+# Columns of the packages table, in order.
+PKGCOLUMNS = (
+    "name",
+    "origin",
+    "version",
+    "comment",
+    "maintainer",
+    "www",
+    "abi",
+    "arch",
+    "prefix",
+    "sum",  # has to be added to file manifest
+    "flatsize",
+    "path",  # has to be added to file manifest
+    "repopath",  # has to be added to file manifest
+    "licenselogic",
+    "pkgsize",  # has to be added to file manifest
+    "desc",
+)
+# Extracts the values for PKGCOLUMNS from a manifest in one call.
+pkgcolumns = operator.itemgetter(*PKGCOLUMNS)
+INSERT_PKG = (
+    f"INSERT INTO packages (rowid, {', '.join(PKGCOLUMNS)}) "
+    f"VALUES ({', '.join('?' * (len(PKGCOLUMNS) + 1))})"
+)
 
-def get_manifest(repopath):
+
+def get_manifest(repopath, fileobj=None):
     """
     Get the manifest from a package.
 
     Arguments:
         repopath (str): Name of the package, including PKGDIR.
+        fileobj (file): Optional binary file object for the opened package.
 
     Note that the manifest is missing some keys that are present in the database:
     * sum: SHA256 checksum of the contents package.
@@ -48,6 +91,18 @@ def get_manifest(repopath):
 
     Returns: a dictionary containing the manifest.
     """
+    try:
+        with tarfile.open(repopath, fileobj=fileobj) as tf:
+            # The manifest comes first, so don't read the whole archive.
+            for member in tf:
+                if member.name == "+COMPACT_MANIFEST":
+                    return json.loads(tf.extractfile(member).read())
+    except tarfile.ReadError:
+        pass  # E.g. zstd compression is not supported by tarfile; use tar.
+    except (tarfile.TarError, OSError):
+        raise ValueError(f"{RED}extracting manifest failed{RESET}")
+    else:
+        raise ValueError(f"{RED}no manifest in package{RESET}")
     args = ("tar", "xOf", repopath, "+COMPACT_MANIFEST")
     rv = sp.run(args, stdout=sp.PIPE, stderr=sp.DEVNULL)
     if rv.returncode != 0:
@@ -55,54 +110,105 @@ def get_manifest(repopath):
     return json.loads(rv.stdout)
 
 
-def insert_pkg(cur, pkg):
+def insert_pkgs(cur, pkgs):
     """
-    Insert a package into the database from its manifest.
+    Insert packages into the database from their manifests.
+
+    The rowids of the packages are assigned here, so that the rows for all
+    tables can be collected first and then inserted with one executemany
+    call per table.
 
     Arguments:
         cur (Cursor): database cursor
-        pkg (dict): manifest for the package
+        pkgs (list): manifests for the packages
     """
-    cur.execute(
-        "INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-        (
-            pkg["name"],
-            pkg["origin"],
-            pkg["version"],
-            pkg["comment"],
-            pkg["maintainer"],
-            pkg["www"],
-            pkg["abi"],
-            pkg["arch"],
-            pkg["prefix"],
-            pkg["sum"],  # has to be added to file manifest
-            pkg["flatsize"],
-            pkg["path"],  # has to be added to file manifest
-            pkg["repopath"],  # has to be added to file manifest
-            pkg["licenselogic"],
-            pkg["pkgsize"],  # has to be added to file manifest
-            pkg["desc"],
-        ),
+    (first,) = cur.execute(
+        "SELECT coalesce(max(rowid), 0) + 1 FROM packages"
+    ).fetchone()
+    pkg_rows, lic_rows, cat_rows, req_rows = [], [], [], []
+    prov_rows, opt_rows, ann_rows = [], [], []
+    for pkgid, pkg in enumerate(pkgs, start=first):
+        pkg_rows.append((pkgid, *pkgcolumns(pkg)))
+        if "licenses" in pkg:
+            lic_rows += [(pkgid, lic) for lic in pkg["licenses"]]
+        if "categories" in pkg:
+            cat_rows += [(pkgid, cat) for cat in pkg["categories"]]
+        if "shlibs_required" in pkg:
+            req_rows += [(pkgid, req) for req in pkg["shlibs_required"]]
+        if "shlibs_provided" in pkg:
+            prov_rows += [(pkgid, prov) for prov in pkg["shlibs_provided"]]
+        if "options" in pkg:
+            opt_rows += [(pkgid, k, v) for k, v in pkg["options"].items()]
+        if "annotations" in pkg:
+            ann_rows += [(pkgid, k, v) for k, v in pkg["annotations"].items()]
+    cur.executemany(INSERT_PKG, pkg_rows)
+    cur.executemany("INSERT INTO licenses VALUES (?, ?)", lic_rows)
+    cur.executemany("INSERT INTO categories VALUES (?, ?)", cat_rows)
+    cur.executemany("INSERT INTO shlibs_required VALUES (?, ?)", req_rows)
+    cur.executemany("INSERT INTO shlibs_provided VALUES (?, ?)", prov_rows)
+    cur.executemany("INSERT INTO options VALUES (?, ?, ?)", opt_rows)
+    cur.executemany("INSERT INTO annotations VALUES (?, ?, ?)", ann_rows)
+
+
+def intern_strings(pkgs):
+    """
+    Replace values that occur in many manifests by a single shared string.
+
+    Arguments:
+        pkgs (list): manifests for the packages
+    """
+    for pkg in pkgs:
+        for key in ("maintainer", "abi", "arch", "prefix", "licenselogic"):
+            pkg[key] = sys.intern(pkg[key])
+        for key in ("licenses", "categories"):
+            if key in pkg:
+                pkg[key] = [sys.intern(j) for j in pkg[key]]
+
+
+def scan(entry, known):
+    """
+    Get the size and SHA256 checksum of a package.
+    For packages that are not known, the manifest is read from the same file.
+
+    Arguments:
+        entry (DirEntry): Directory entry of the package in PKGDIR.
+        known (set): Names of the packages in the database.
+
+    Returns: a tuple (completename, size, checksum, manifest).
+    The manifest is None for known packages and when it could not be read.
+    """
+    completename = PKGDIR + entry.name
+    cursize = entry.stat().st_size
+    h = hashlib.sha256(usedforsecurity=False)
+    buf = memoryview(bytearray(1 << 20))
+    manifest = None
+    with open(completename, "rb") as filecontents:
+        while n := filecontents.readinto(buf):
+            h.update(buf[:n])
+        if PKGRE.search(completename)[1] not in known:
+            filecontents.seek(0)
+            try:
+                manifest = get_manifest(completename, filecontents)
+            except ValueError:
+                pass
+    return completename, cursize, h.hexdigest(), manifest
+
+
+def version_key(version):
+    """
+    Make a key that sorts package versions in order, comparing the numeric
+    parts as numbers. So "1.10" sorts after "1.9".
+
+    Arguments:
+        version (str): Version of a package.
+
+    Returns: a tuple that can be compared with other keys.
+    """
+    return tuple(
+        (1, int(part), "") if part.isdigit() else (0, 0, part)
+        for part in VERRE.split(version)
+        if part
     )
-    pkgid = cur.lastrowid
-    if "licenses" in pkg:
-        for lic in pkg["licenses"]:
-            cur.execute("INSERT INTO licenses VALUES (?, ?)", (pkgid, lic))
-    if "categories" in pkg:
-        for cat in pkg["categories"]:
-            cur.execute("INSERT INTO categories VALUES (?, ?)", (pkgid, cat))
-    if "shlibs_required" in pkg:
-        for req in pkg["shlibs_required"]:
-            cur.execute("INSERT INTO shlibs_required VALUES (?, ?)", (pkgid, req))
-    if "shlibs_provided" in pkg:
-        for prov in pkg["shlibs_provided"]:
-            cur.execute("INSERT INTO shlibs_provided VALUES (?, ?)", (pkgid, prov))
-    if "options" in pkg:
-        for k, v in pkg["options"].items():
-            cur.execute("INSERT INTO options VALUES (?, ?, ?)", (pkgid, k, v))
-    if "annotations" in pkg:
-        for k, v in pkg["annotations"].items():
-            cur.execute("INSERT INTO annotations VALUES (?, ?, ?)", (pkgid, k, v))
 
 
 def download(repopath):
@@ -118,24 +224,33 @@ def download(repopath):
         "--output-dir",
         PKGDIR,
         "-O",
-        f"http://pkg.freebsd.org/{ABI}/{REL}/" + repopath,
+        BASEURL + repopath,
     ]
     print(f"downloading {repopath}... ", end="")
     cp = sp.run(args)
     if cp.returncode != 0:
         print(f"{RED}failed with code {cp.returncode}{RESET} ", end="")
+    # curl stores the file under its base name in PKGDIR.
+    path = PKGDIR + os.path.basename(repopath)
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
     # Make packages readable for everyone.
-    os.chmod(PKGDIR[:-4] + repopath, 0o0644)
+    if mode & 0o777 != 0o644:
+        os.chmod(path, 0o644)
 
 
 # Main program starts here
 if __name__ == "__main__":
     start = time.monotonic()
     print("Loading package info from yaml file... ", end="")
-    with open("packagesite.yaml") as yf:
-        lines = [ln.strip() for ln in yf.readlines()]
-    jsondata = "[" + ", ".join(lines) + "]"
+    # Every line in packagesite.yaml is a JSON object.
+    with open("packagesite.yaml", "rb") as yf:
+        jsondata = b"[" + b",".join(yf.read().splitlines()) + b"]"
     packages = json.loads(jsondata)
+    del jsondata
+    intern_strings(packages)
     print(f"{GREEN}done{RESET}")
     print(f"{BOLD_WHITE}Found {len(packages)} packages.{RESET}")
 
@@ -145,9 +260,17 @@ if __name__ == "__main__":
         print("Old database removed.")
 
     # Create database
-    db = sqlite3.connect("packagesite.db")
+    # Transactions are managed explicitly, not by the sqlite3 module.
+    db = sqlite3.connect("packagesite.db", isolation_level=None)
     print(f"{GREEN}Database created.{RESET}")
     cur = db.cursor()
+    # Speed up the bulk load. This is not crash-safe, but since the database
+    # is always rebuilt from scratch from packagesite.yaml, that doesn't matter.
+    cur.executescript(
+        "PRAGMA synchronous=OFF; PRAGMA journal_mode=OFF; "
+        "PRAGMA temp_store=MEMORY; PRAGMA locking_mode=EXCLUSIVE; "
+        "PRAGMA cache_size=-200000;"
+    )
 
     # Create tables
     tbls = """CREATE TABLE packages (name TEXT, origin TEXT,
@@ -163,46 +286,61 @@ if __name__ == "__main__":
     CREATE TABLE annotations (pkgid INT, key TEXT, value TEXT);
     """
     cur.executescript(tbls)
-    db.commit()
     print(f"{GREEN}Tables created.{RESET}")
 
     print("Inserting data into tables... ", end="")
-    for pkg in packages:  # noqa
-        insert_pkg(cur, pkg)
-    db.commit()
+    # Each phase runs in a single transaction.
+    cur.execute("BEGIN IMMEDIATE")
+    insert_pkgs(cur, packages)
+    # Indices are created after the bulk insert; that is faster.
+    cur.execute("CREATE INDEX idx_pkg_name ON packages(name)")
+    cur.execute("COMMIT")
     print(f"{GREEN}done.{RESET}")
 
     # Insert packages from repo that are not in the database,
     # Download new versions and size/checksum mismatches.
     print("Inserting packages not in database... ")
-    for completename in glob.glob(PKGDIR + "*.pkg"):
-        repopath = completename.removeprefix(REPO)
-        cursize = os.path.getsize(completename)
-        with open(completename, "rb") as filecontents:
-            data = filecontents.read()
-            cursum = hashlib.sha256(data).hexdigest()
-            del data
-        pkgname, curver = completename[9:-4].rsplit("-", maxsplit=1)
-        try:
-            pkgid, dbsum, dbsize, dbver = cur.execute(
-                "SELECT rowid, sum, pkgsize, version FROM packages WHERE name==?",
-                (pkgname,)
-            ).fetchone()
-        except (ValueError, TypeError):
-            print(f"{CYAN}Adding {pkgname} to database...{RESET}", end=" ")
-            try:
-                manifest = get_manifest(completename)
-                # Add missing data.
-                manifest["sum"] = cursum
-                manifest["repopath"] = repopath
-                manifest["path"] = repopath
-                manifest["pkgsize"] = cursize
-                insert_pkg(cur, manifest)
-                packages.append(manifest)
-            except ValueError:
-                print(f"{RED}(skipping {pkgname}, could not get manifest){RESET}")
+    # Hashing releases the GIL, so the packages can be scanned in parallel.
+    with os.scandir(PKGDIR) as entries:
+        pkgfiles = []
+        for e in entries:
+            if not e.name.endswith(".pkg"):
+                continue
+            if PKGRE.search(e.name):
+                pkgfiles.append(e)
             else:
-                print(f"{GREEN}done.{RESET}")
+                print(f"{PURPLE}(skipping {e.name}, no version in name){RESET}")
+    known = set(pkg["name"] for pkg in packages)
+    with cf.ThreadPoolExecutor(max_workers=2 * (os.cpu_count() or 1)) as ex:
+        scanned = list(ex.map(scan, pkgfiles, [known] * len(pkgfiles)))
+    del known
+    cur.execute("BEGIN IMMEDIATE")
+    # Compare the packages in the repo with the database in a single query.
+    cur.execute(
+        "CREATE TEMP TABLE scan (idx INTEGER PRIMARY KEY, name TEXT, "
+        "version TEXT, sum TEXT, size INT)"
+    )
+    cur.executemany(
+        "INSERT INTO scan VALUES (?, ?, ?, ?, ?)",
+        (
+            (idx, *PKGRE.search(completename).groups(), cursum, cursize)
+            for idx, (completename, cursize, cursum, _) in enumerate(scanned)
+        ),
+    )
+    compared = cur.execute(
+        "SELECT idx, scan.name, scan.version, packages.version, "
+        "scan.sum, packages.sum, scan.size, packages.pkgsize "
+        "FROM scan LEFT JOIN packages ON packages.name = scan.name ORDER BY idx"
+    ).fetchall()
+    newpkgs = {}
+    for idx, pkgname, curver, dbver, cursum, dbsum, cursize, dbsize in compared:
+        completename, _, _, manifest = scanned[idx]
+        repopath = completename.removeprefix(REPO)
+        if dbver is None:
+            # There can be several versions of a package that is not in the
+            # database; they are sorted out below.
+            new = (repopath, curver, cursize, cursum, manifest)
+            newpkgs.setdefault(pkgname, []).append(new)
             continue
         reason = []
         if dbver != curver:
@@ -218,22 +356,61 @@ if __name__ == "__main__":
             os.remove(completename)
             download(repopath)
             print(f"{GREEN}done.{RESET}")
-    db.commit()
+    manifests = []
+    for pkgname, versions in newpkgs.items():
+        # Only the newest version is added.
+        versions.sort(key=lambda n: version_key(n[1]))
+        repopath, _, cursize, cursum, manifest = versions.pop()
+        print(f"{CYAN}Adding {pkgname} to database...{RESET}", end=" ")
+        if manifest is None:
+            # Keep the older versions; they might be the only usable ones.
+            print(f"{RED}(skipping {pkgname}, could not get manifest){RESET}")
+            continue
+        # Add missing data.
+        manifest["sum"] = cursum
+        manifest["repopath"] = repopath
+        manifest["path"] = repopath
+        manifest["pkgsize"] = cursize
+        manifests.append(manifest)
+        print(f"{GREEN}done.{RESET}")
+        for oldpath, oldver, *_ in versions:
+            print(f"{PURPLE}Removing older version {oldver} of {pkgname}.{RESET}")
+            os.remove(REPO + oldpath)
+    insert_pkgs(cur, manifests)
+    packages += manifests
+    cur.execute("COMMIT")
 
     # Only after all packages have been ID'd can we resolve deps.
     print("Resolving dependencies... ", end="")
+    cur.execute("BEGIN IMMEDIATE")
     idbyname = dict(cur.execute("SELECT name, rowid FROM packages").fetchall())
+    dep_rows = []
     for pkg in packages:
         if "deps" in pkg:
+            pkgid = idbyname[pkg["name"]]
             for depname, depdata in pkg["deps"].items():
-                deporig, depver = depdata.values()
                 depid = idbyname.get(depname, -1)
-                cur.execute(
-                    "INSERT INTO deps VALUES (?, ?, ?, ?, ?)",
-                    (idbyname[pkg["name"]], depname, deporig, depver, depid),
+                dep_rows.append(
+                    (pkgid, depname, depdata["origin"], depdata["version"], depid)
                 )
+    cur.executemany("INSERT INTO deps VALUES (?, ?, ?, ?, ?)", dep_rows)
+    cur.execute("CREATE INDEX idx_deps_pkgid_depid ON deps(pkgid, depid)")
+    cur.execute("CREATE INDEX idx_deps_depid_pkgid ON deps(depid, pkgid)")
     print(f"{GREEN}done.{RESET}")
-    db.commit()
+    cur.execute("COMMIT")
+
+    # Index the package names for substring searches by repotool.
+    print("Indexing package names... ", end="")
+    try:
+        cur.execute(
+            "CREATE VIRTUAL TABLE packages_fts USING fts5(name, "
+            "content='packages', content_rowid='rowid', tokenize='trigram')"
+        )
+        cur.execute("INSERT INTO packages_fts(packages_fts) VALUES ('rebuild')")
+    except sqlite3.OperationalError:
+        print(f"{RED}FTS5 trigram tokenizer not available.{RESET}")
+    else:
+        print(f"{GREEN}done.{RESET}")
     db.close()
     runtime = time.monotonic() - start
     print(f"{YELLOW}Duration: {runtime:.3f} s.{RESET}")
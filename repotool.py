@@ -5,12 +5,15 @@
 # Copyright © 2022 R.F. Smith <rsmith@xs4all.nl>
 # SPDX-License-Identifier: MIT
 # Created: 2022-10-09T23:14:51+0200
-# Last modified: 2024-09-15T11:15:01+0200
+# Last modified: 2026-10-15T18:01:34+0200
 
-import glob
+import concurrent.futures as cf
+import fcntl
 import hashlib
 import json
+import mmap
 import os
+import re
 import sqlite3
 import subprocess as sp
 import sys
@@ -19,9 +22,22 @@ import time
 # Configuration
 ABI = "FreeBSD:14:amd64"
 REL = "quarterly"
+BASEURL = f"http://pkg.freebsd.org/{ABI}/{REL}/"
 REPODIR = f"/home/{os.getenv('USER')}/freebsd-quarterly"
 REPO = "repo/"
 PKGDIR = REPO + "All/"  # must end with path separator.
+DOWNLOADS = 8  # maximum number of parallel downloads.
+LOCKFILE = "repotool.lock"  # relative to REPODIR.
+
+# Indices used by the queries, with the statements that create them.
+INDICES = {
+    "idx_pkg_name": "CREATE INDEX idx_pkg_name ON packages(name)",
+    "idx_deps_pkgid_depid": "CREATE INDEX idx_deps_pkgid_depid ON deps(pkgid, depid)",
+    "idx_deps_depid_pkgid": "CREATE INDEX idx_deps_depid_pkgid ON deps(depid, pkgid)",
+}
+
+# Splits the file name of a package into name and version.
+PKGRE = re.compile(r"([^/]+)-([^-/]+)\.pkg$")
 
 # Colors
 BOLD_WHITE = "\033[1;37m"
@@ -34,32 +50,6 @@ YELLOW = "\033[0;33m"
 BOLD_YELLOW = "\033[1;33m"
 RESET = "\033[0m"  # No Color
 
-# Supported commands
-cmds = [
-    "list",
-    "show",
-    "contains",
-    "get",
-    "delete",
-    "info",
-    "leaves",
-    "refresh",
-    "unused",
-    "check",
-]
-help = [
-    "show all available packages",
-    "show what would be downloaded for a given package name",
-    "print the names of packages that contain the given string",
-    "download the given package, plus any required dependencies",
-    "delete a package if it is unused, plus any unused dependencies",
-    "show information about a named package",
-    "show all packages that are not depended on",
-    "for every package, check and update the requirements",
-    "show packages in the repo that are not installed",
-    "for every package, check size and checksum",
-]
-
 
 def main():  # noqa
     start = time.monotonic()
@@ -71,10 +61,10 @@ def main():  # noqa
         sys.exit(1)
     # Handle arguments
     args = sys.argv[1:]
-    if len(args) == 0 or args[0] not in cmds:
-        print(f"usage: {sys.argv[0]} {'|'.join(cmds)} pkgname")
-        for a, b in zip(cmds, help):
-            print(f"* {BOLD_WHITE}{a:8}{RESET}: {b}.")
+    if len(args) == 0 or args[0] not in commands:
+        print(f"usage: {sys.argv[0]} {'|'.join(commands)} pkgname")
+        for name, (_, _, text) in commands.items():
+            print(f"* {BOLD_WHITE}{name:8}{RESET}: {text}.")
         sys.exit(0)
     if not os.path.isdir(PKGDIR):
         print(f"{RED}Error: “{PKGDIR}” not found in “{REPODIR}”.{RESET}")
@@ -82,35 +72,53 @@ def main():  # noqa
     cmd = args[0]
     pkgname = args[1] if len(args) > 1 else ""
 
-    # Check if other important repotool jobs are running.
-    check_running()
+    cur = opendb()
+
+    # Process commands.
+    dispatch(cur, start, cmd, pkgname)
+
 
-    # Load database.
-    # See makedb.py for the database definition.
+def opendb():
+    """
+    Open the package database.
+    See makedb.py for the database definition.
+
+    Returns: a cursor for the database.
+    """
     db = sqlite3.connect("packagesite.db")
     cur = db.cursor()
+    # Databases made by older versions of makedb lack some of the indices.
+    # Only write to the database when one is actually missing.
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+    present = set(n for (n,) in cur)
+    for name, create in INDICES.items():
+        if name not in present:
+            cur.execute(create)
+    # The commands only read from the database, so there is nothing to
+    # journal or sync.
+    cur.executescript(
+        "PRAGMA query_only=1; PRAGMA journal_mode=OFF; PRAGMA synchronous=OFF; "
+        "PRAGMA temp_store=MEMORY; PRAGMA cache_size=-131072; "
+        "PRAGMA mmap_size=268435456;"
+    )
+    return cur
 
-    # Process commands.
-    if cmd == "list":
-        cmd_list(cur, start)
-    elif cmd == "contains":
-        cmd_contains(cur, start, pkgname)
-    elif cmd == "info":
-        cmd_info(cur, start, pkgname)
-    elif cmd == "show":
-        cmd_show(cur, start, pkgname)
-    elif cmd == "get":
-        cmd_get(cur, start, pkgname)
-    elif cmd == "delete":
-        cmd_delete(cur, start, pkgname)
-    elif cmd == "leaves":
-        cmd_leaves(cur, start)
-    elif cmd == "refresh":
-        cmd_refresh(cur, start)
-    elif cmd == "unused":
-        cmd_unused(cur, start)
-    elif cmd == "check":
-        cmd_check(cur, start)
+
+def dispatch(cur, start, cmd, pkgname):
+    """
+    Run a single command.
+
+    Arguments:
+        cur (Cursor): Sqlite database cursor.
+        start (float): Start time.
+        cmd (str): Name of the command.
+        pkgname (str): Argument for the command; may be empty.
+    """
+    # Check if other important repotool jobs are running.
+    with check_running(cmd):
+        function, argnames, _ = commands[cmd]
+        values = {"start": start, "pkgname": pkgname}
+        function(cur, *(values[name] for name in argnames))
 
 
 def cmd_list(cur, start):
@@ -122,10 +130,11 @@ def cmd_list(cur, start):
         start (float): Start time.
     """
     cur.execute("SELECT repopath FROM packages ORDER BY repopath ASC")
-    for j in cur.fetchall():
-        print(j[0][4:])
-    duration = time.monotonic() - start
-    print(f"{YELLOW}# duration: {duration:.3f} s{RESET}")
+    sys.stdout.writelines(f"{rp[4:]}\n" for (rp,) in cur)
+    # Keep the output clean when it is piped into another program.
+    if sys.stdout.isatty():
+        duration = time.monotonic() - start
+        print(f"{YELLOW}# duration: {duration:.3f} s{RESET}")
 
 
 def cmd_contains(cur, start, pkgname):
@@ -137,10 +146,11 @@ def cmd_contains(cur, start, pkgname):
         start (float): Start time.
         pkgname (str): Fragment to search for in the package name.
     """
-    for p in contains(cur, pkgname):
-        print(p)
-    duration = time.monotonic() - start
-    print(f"{YELLOW}# duration: {duration:.3f} s{RESET}")
+    sys.stdout.writelines(f"{p}\n" for p in contains(cur, pkgname))
+    # Keep the output clean when it is piped into another program.
+    if sys.stdout.isatty():
+        duration = time.monotonic() - start
+        print(f"{YELLOW}# duration: {duration:.3f} s{RESET}")
 
 
 def cmd_info(cur, start, pkgname):
@@ -153,7 +163,7 @@ def cmd_info(cur, start, pkgname):
         pkgname (str): Fragment to search for in the package name.
     """
     cur.execute(
-        "SELECT origin, version, repopath, comment, www FROM packages WHERE name IS ?",
+        "SELECT origin, version, repopath, comment, www FROM packages WHERE name = ?",
         (pkgname,),
     )
     try:
@@ -180,7 +190,7 @@ def cmd_show(cur, start, pkgname):
         pkgname (str): Name of the package.
     """
     cur.execute(
-        "SELECT origin, version, repopath, comment FROM packages WHERE name IS ?",
+        "SELECT origin, version, repopath, comment FROM packages WHERE name = ?",
         (pkgname,),
     )
     try:
@@ -192,15 +202,11 @@ def cmd_show(cur, start, pkgname):
         print(f"Comment: {comment}")
         print("---------------------")
         print("Packages to retrieve:")
-        rps = deps(cur, pkgname)
-        alldeps = [
-            cur.execute("SELECT repopath FROM packages WHERE rowid IS ?", d).fetchone()
-            for d in rps
-        ]
-        for rp in alldeps:
-            pkgname = rp[0].split("/")[-1]
-            if not os.path.exists(PKGDIR + pkgname):
-                print(BOLD_WHITE + rp[0] + RESET)
+        present = pkgfiles()
+        for _, rp in deps(cur, pkgname):
+            pkgname = rp.split("/")[-1]
+            if pkgname not in present:
+                print(BOLD_WHITE + rp + RESET)
             else:
                 print(f"# skipping {pkgname}, already exists.")
     except TypeError:
@@ -219,18 +225,20 @@ def cmd_get(cur, start, pkgname):
         pkgname (str): Name of the package.
     """
     print("Retrieving packages:")
-    rps = deps(cur, pkgname)
-    alldeps = [
-        cur.execute("SELECT repopath FROM packages WHERE rowid IS ?", d).fetchone()
-        for d in rps
-        if d != (-1,)
-    ]
-    for rp in alldeps:
-        pkgname = rp[0].split("/")[-1]
-        if not os.path.exists(PKGDIR + pkgname):
-            download(rp[0])
+    try:
+        alldeps = deps(cur, pkgname)
+    except ValueError:
+        print(f"# package “{pkgname}” does not exist.")
+        alldeps = []
+    present = pkgfiles()
+    missing = []
+    for _, rp in alldeps:
+        pkgname = rp.split("/")[-1]
+        if pkgname not in present:
+            missing.append(rp)
         else:
             print(f"{PURPLE}# skipping {pkgname}, already exists.{RESET}")
+    download(missing)
     duration = time.monotonic() - start
     print(f"{YELLOW}# duration: {duration:.3f} s{RESET}")
 
@@ -252,14 +260,15 @@ def cmd_delete(cur, start, pkgname):
 
     # Get the row id and path in the repo of the package
     rv = cur.execute(
-        "SELECT rowid, repopath FROM packages WHERE name is ?", (pkgname,)
+        "SELECT rowid, repopath FROM packages WHERE name = ?", (pkgname,)
     ).fetchone()
     if rv is None:
         print(f"# package “{pkgname}” is not in the database")
         duration()
         return
     rowid, repopath = rv
-    if not os.path.exists(REPO + repopath):
+    present = pkgfiles()
+    if os.path.basename(repopath) not in present:
         print(f"# package “{pkgname}” is not in the repo")
         duration()
         return
@@ -267,14 +276,14 @@ def cmd_delete(cur, start, pkgname):
     # Note that those packages might or might not actually be there!
     dependers = cur.execute(
         "SELECT name, repopath, rowid FROM packages WHERE rowid IN "
-        "(SELECT pkgid FROM deps WHERE depid IS ?)",
+        "(SELECT pkgid FROM deps WHERE depid = ?)",
         (rowid,),
     ).fetchall()
     # Narrow the selection down to other packages that actually exist
     existing_dependers = [
         (name, rowid)
         for name, repopath, rowid in dependers
-        if os.path.exists(REPO + repopath)
+        if os.path.basename(repopath) in present
     ]
     if existing_dependers:
         print(
@@ -286,8 +295,6 @@ def cmd_delete(cur, start, pkgname):
         return
     else:
         print(f"# package “{pkgname}” is not depended on, so it can be deleted.")
-    dependencies = deps(cur, pkgname)
-    print(f"# found {len(dependencies)} dependencies.")
     # TODO: Delete the package.
     # TODO: Recursively delete dependencies if they have no other packages
     # that depend on them.
@@ -302,26 +309,32 @@ def cmd_refresh(cur, start):
         cur (Cursor): Sqlite database cursor.
         start (float): Start time.
     """
-    presentnames = [
-        j.replace(PKGDIR, "").rsplit("-", maxsplit=1)[0]
-        for j in glob.glob(PKGDIR + "*.pkg")
-    ]
+    present = pkgfiles()
+    presentnames = list(pkgnames(present).values())
+    # The names are bound as one JSON array, so that the number of packages
+    # is not limited by SQLITE_MAX_VARIABLE_NUMBER.
+    known = set(
+        n
+        for (n,) in cur.execute(
+            "SELECT name FROM packages WHERE name IN "
+            "(SELECT value FROM json_each(?))",
+            (json.dumps(presentnames),),
+        )
+    )
     for pkgname in presentnames:
-        print(f"Refreshing {pkgname}")
-        try:
-            rps = deps(cur, pkgname)
-        except (ValueError, TypeError):
+        if pkgname in known:
+            print(f"Refreshing {pkgname}")
+        else:
             print(f"{PURPLE}# skipping {pkgname}, not in database{RESET}")
-            continue
-        alldeps = [
-            cur.execute("SELECT repopath FROM packages WHERE rowid IS ?", d).fetchone()
-            for d in rps
-            if d != (-1,)
-        ]
-        for rp in alldeps:
-            rpkgname = rp[0].split("/")[-1]
-            if not os.path.exists(PKGDIR + rpkgname):
-                download(rp[0])
+    # Walk the dependencies of all packages at once, so that shared
+    # dependencies are only visited once.
+    missing = []
+    if known:
+        for _, rp in deps(cur, *known):
+            rpkgname = rp.split("/")[-1]
+            if rpkgname not in present:
+                missing.append(rp)
+    download(missing)
     duration = time.monotonic() - start
     print(f"{YELLOW}# duration: {duration:.3f} s{RESET}")
 
@@ -334,25 +347,18 @@ def cmd_leaves(cur, start):
         cur (Cursor): Sqlite database cursor.
         start (float): Start time.
     """
-    pkgdict = dict(cur.execute("SELECT repopath, rowid FROM packages"))
-    presentnames = [j.replace(PKGDIR, "All/") for j in glob.glob(PKGDIR + "*.pkg")]
-    presentpkgs = set((pkgdict.get(n),) for n in presentnames)
-    presentpkgs.remove((None,))
-    leaves = set()
-    for p in presentpkgs:
-        pdeps = set(
-            j
-            for j in cur.execute("SELECT pkgid FROM deps WHERE depid IS ?", p)
-            if j in presentpkgs
-        )
-        if len(pdeps) == 0:
-            leaves.add(p)
-    leafnames = sorted(
-        cur.execute("SELECT repopath FROM packages WHERE rowid IS ?", p)
-        .fetchone()[0]
-        .split("/")[-1]
-        for p in leaves
+    presentnames = ["All/" + j for j in pkgfiles()]
+    # Leaves are present packages that no other present package depends on.
+    leaves = cur.execute(
+        "WITH present(id, repopath) AS ("
+        "SELECT rowid, repopath FROM packages WHERE repopath IN "
+        "(SELECT value FROM json_each(?))) "
+        "SELECT repopath FROM present WHERE NOT EXISTS ("
+        "SELECT 1 FROM deps JOIN present AS dependers ON dependers.id = deps.pkgid "
+        "WHERE deps.depid = present.id)",
+        (json.dumps(presentnames),),
     )
+    leafnames = sorted(rp.split("/")[-1] for (rp,) in leaves)
     for p in leafnames:
         print(p)
     duration = time.monotonic() - start
@@ -361,19 +367,23 @@ def cmd_leaves(cur, start):
 
 def cmd_unused(cur, start):
     """
-    Print those names from PKGDIR which are not depended on.
+    Print those names from PKGDIR which are not installed.
 
     Arguments:
         cur (Cursor): Sqlite database cursor.
         start (float): Start time.
     """
-    duration = time.monotonic() - start
-    pkgdata = sp.check_output(["pkg", "info"]).decode("utf-8")
+    # Let pkg read its database while the repo is scanned.
+    proc = sp.Popen(["pkg", "info"], stdout=sp.PIPE, text=True)
+    repopkgs = set(j.removesuffix(".pkg") for j in pkgfiles())
+    pkgdata, _ = proc.communicate()
+    if proc.returncode != 0:
+        raise sp.CalledProcessError(proc.returncode, proc.args)
     installedpkgs = set(ln.split()[0] for ln in pkgdata.splitlines())
-    repopkgs = set(pkgname[9:-4] for pkgname in glob.glob(PKGDIR + "*.pkg"))
     uninstalled = sorted(repopkgs - installedpkgs)
     for pkg in uninstalled:
         print(pkg)
+    duration = time.monotonic() - start
     print(f"{YELLOW}# duration: {duration:.3f} s{RESET}")
 
 
@@ -385,103 +395,286 @@ def cmd_check(cur, start):
         cur (Cursor): Sqlite database cursor.
         start (float): Start time.
     """
-    for completename in glob.glob(PKGDIR + "*.pkg"):
-        cursize = os.path.getsize(completename)
-        with open(completename, "rb") as filecontents:
-            data = filecontents.read()
-        cursum = hashlib.sha256(data).hexdigest()
-        pkgname = completename[9:-4].rsplit("-", maxsplit=1)[0]
-        try:
-            dbsum, dbsize = cur.execute(
-                "SELECT sum, pkgsize FROM packages WHERE name==?", (pkgname,)
-            ).fetchone()
-        except (ValueError, TypeError):
+    sizes = pkgsizes()
+    filenames = pkgnames(sizes)
+    present, names = list(filenames), list(filenames.values())
+    dbdata = {
+        name: (dbsum, dbsize)
+        for name, dbsum, dbsize in cur.execute(
+            "SELECT name, sum, pkgsize FROM packages WHERE name IN "
+            "(SELECT value FROM json_each(?))",
+            (json.dumps(names),),
+        )
+    }
+    checked = []
+    for filename, pkgname in zip(present, names):
+        if pkgname not in dbdata:
             print(f"{PURPLE}# skipping {pkgname}, not in database{RESET}")
             continue
-        # print(f"Checking {pkgname}", end="")
-        if dbsum != cursum:
-            print(f"\n{CYAN}# CHECKSUM package “{pkgname}” differs{RESET}")
-            print(f"{CYAN}# current package: {cursum}{RESET}")
-            print(f"{CYAN}# database: {dbsum}{RESET}")
-        elif dbsize != cursize:
+        # A package with the wrong size cannot have the right checksum,
+        # so there is no need to hash it.
+        cursize, dbsize = sizes[filename], dbdata[pkgname][1]
+        if dbsize != cursize:
             print(f"\n{CYAN}# SIZE package “{pkgname}”; {cursize} → {dbsize}{RESET}")
+        else:
+            checked.append((filename, pkgname))
+    # Hashing releases the GIL, so the packages can be hashed in parallel.
+    with cf.ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        sums = ex.map(sha256file, (PKGDIR + filename for filename, _ in checked))
+        for (filename, pkgname), cursum in zip(checked, sums):
+            dbsum = dbdata[pkgname][0]
+            # print(f"Checking {pkgname}", end="")
+            if dbsum != cursum:
+                print(f"\n{CYAN}# CHECKSUM package “{pkgname}” differs{RESET}")
+                print(f"{CYAN}# current package: {cursum}{RESET}")
+                print(f"{CYAN}# database: {dbsum}{RESET}")
     duration = time.monotonic() - start
     print(f"{YELLOW}# duration: {duration:.3f} s{RESET}")
 
 
+def cmd_repl(cur):
+    """
+    Read commands from standard input and run them until end of file.
+    Opening the database and warming its cache is only done once, which
+    helps when running several commands in a row.
+
+    Arguments:
+        cur (Cursor): Sqlite database cursor.
+    """
+    prompt = "repotool> " if sys.stdin.isatty() else ""
+    inode = os.stat("packagesite.db").st_ino
+    while True:
+        try:
+            line = input(prompt).split(maxsplit=1)
+        except EOFError:
+            break
+        except KeyboardInterrupt:
+            print()
+            continue
+        if not line:
+            continue
+        cmd = line[0]
+        if cmd in ("quit", "exit"):
+            break
+        if cmd not in commands or cmd == "repl":
+            print(f"{RED}Error: unknown command “{cmd}”.{RESET}")
+            continue
+        pkgname = line[1] if len(line) > 1 else ""
+        # A failing command should not end the session.
+        try:
+            # makedb replaces the database file; use the new one when it has.
+            if os.stat("packagesite.db").st_ino != inode:
+                cur.connection.close()
+                cur = opendb()
+                inode = os.stat("packagesite.db").st_ino
+            dispatch(cur, time.monotonic(), cmd, pkgname)
+        except SystemExit:
+            pass  # The command has already explained why it stopped.
+        except KeyboardInterrupt:
+            print(f"\n{RED}Interrupted.{RESET}")
+        except Exception as e:
+            print(f"{RED}Error: {e}{RESET}")
+
+
+def pkgfiles():
+    """Return a set of the file names of the packages in PKGDIR."""
+    with os.scandir(PKGDIR) as entries:
+        return {e.name for e in entries if e.name.endswith(".pkg")}
+
+
+def pkgsizes():
+    """Return a dict mapping the file names of the packages in PKGDIR to their size."""
+    with os.scandir(PKGDIR) as entries:
+        return {e.name: e.stat().st_size for e in entries if e.name.endswith(".pkg")}
+
+
+def pkgnames(filenames):
+    """
+    Get the package names from the file names of packages.
+    Files that are not named like “name-version.pkg” are reported and left out.
+
+    Arguments:
+        filenames (iterable): File names of packages.
+
+    Returns: a dict mapping the file names to the package names.
+    """
+    rv = {}
+    for filename in filenames:
+        if m := PKGRE.search(filename):
+            rv[filename] = m[1]
+        else:
+            print(f"{PURPLE}# skipping {filename}, no version in name{RESET}")
+    return rv
+
+
+def sha256file(path):
+    """
+    Calculate the SHA256 checksum of a file.
+    The file is mapped into memory, so its pages are hashed without first
+    being copied into a buffer.
+
+    Arguments:
+        path (str): Name of the file.
+
+    Returns: the checksum as a hexadecimal string.
+    """
+    # The checksum is only compared, not used for security.
+    # That lets hashlib skip the FIPS checks on OpenSSL builds that have them.
+    h = hashlib.sha256(usedforsecurity=False)
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+        except ValueError:
+            # Empty files cannot be mapped.
+            return h.hexdigest()
+        with mm:
+            # Let the kernel read ahead and drop pages that have been hashed.
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            h.update(mm)
+        # A check reads every package once; keep them from crowding out
+        # the page cache.
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return h.hexdigest()
+
+
 def contains(cur, s):
     """Return a list of package names that contain s."""
-    cur.execute(f"SELECT name FROM packages WHERE name LIKE '%{s}%'")
+    # The trigram index made by makedb needs at least three characters.
+    if len(s) >= 3:
+        try:
+            cur.execute(
+                "SELECT name FROM packages_fts WHERE packages_fts MATCH ? "
+                "ORDER BY name",
+                ('"' + s.replace('"', '""') + '"',),
+            )
+            return [j[0] for j in cur]
+        except sqlite3.OperationalError:
+            pass  # Database without packages_fts.
+    # Escape the LIKE wildcards, so that they match literally, as in FTS.
+    pattern = s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    cur.execute(
+        "SELECT name FROM packages WHERE name LIKE ? ESCAPE '\\' ORDER BY name",
+        ("%" + pattern + "%",),
+    )
     return [j[0] for j in cur]
 
 
-def deps(cur, name):
+def deps(cur, *names):
     """
-    Find all the dependencies of a package.
+    Find all the dependencies of one or more packages.
 
     Arguments:
         cur (Cursor): database cursor
-        name (str): name of the package
-
-    Returns: a list of rowids of dependencies.
-    """
-    cur.execute("SELECT rowid FROM packages WHERE name IS ?", (name,))
-    pkgid = cur.fetchone()
-    alldeps = []
-    newdeps = [pkgid]
-    while len(newdeps) >= len(alldeps):
-        alldeps += [j for j in newdeps if j not in alldeps]
-        newdeps = cur.execute(
-            "SELECT DISTINCT depid FROM deps WHERE pkgid IN "
-            + "("
-            + ", ".join(str(j[0]) for j in alldeps)
-            + ")"
-        ).fetchall()
-    rv = [pkgid]
-    rv += [j for j in alldeps if j not in rv]
+        names (str): names of the packages
+
+    Raises: ValueError if none of the packages are in the database.
+
+    Returns: a list of (rowid, repopath) tuples for the packages and their
+    dependencies. Shared dependencies are only listed once.
+    """
+    # SQLite walks the dependency graph. UNION discards duplicates,
+    # which also takes care of cycles. Joining with packages drops
+    # dependencies that are not in the database (depid -1).
+    # The names are bound as one JSON array, so that their number is not
+    # limited by SQLITE_MAX_VARIABLE_NUMBER.
+    rv = cur.execute(
+        "WITH RECURSIVE closure(id, repopath) AS ("
+        "SELECT rowid, repopath FROM packages WHERE name IN "
+        "(SELECT value FROM json_each(?)) "
+        "UNION SELECT depid, packages.repopath FROM deps "
+        "JOIN closure ON deps.pkgid = closure.id "
+        "JOIN packages ON packages.rowid = deps.depid) "
+        "SELECT id, repopath FROM closure",
+        (json.dumps(names),),
+    ).fetchall()
+    if not rv:
+        raise ValueError(f"package “{', '.join(names)}” not in database")
     return rv
 
 
-def download(repopath):
+def download(repopaths):
     """
-    Download package.
+    Download packages with a single curl process.
+    The downloads run in parallel and share connections.
 
     Arguments:
-        repopath (str): Name of the package to download.
+        repopaths (list): Names of the packages to download.
     """
+    if not repopaths:
+        return
     args = [
         "curl",
-        "-s",
+        "--no-progress-meter",
+        "-f",
+        "--remove-on-error",
+        "--write-out",
+        "%{exitcode} %{url}\n",
+        "--parallel",
+        "--parallel-max",
+        str(DOWNLOADS),
         "--output-dir",
         PKGDIR,
-        "-O",
-        f"http://pkg.freebsd.org/{ABI}/{REL}/" + repopath,
+        "-K",
+        "-",
     ]
-    print(f"Downloading “{repopath}”... ", end="")
-    cp = sp.run(args)
-    if cp.returncode != 0:
-        print(f"{RED}failed, code {cp.returncode}.{RESET}")
-    else:
+    # Pass the URLs as a config file on stdin, so the number of packages
+    # is not limited by the maximum length of the command line.
+    config = "".join(f'url = "{BASEURL}{rp}"\n-O\n' for rp in repopaths)
+    cp = sp.run(args, input=config, stdout=sp.PIPE, text=True)
+    # curl writes the result of every transfer on a line of its own.
+    codes = {}
+    for ln in cp.stdout.splitlines():
+        code, url = ln.split(" ", maxsplit=1)
+        codes[url] = int(code)
+    for rp in repopaths:
+        print(f"Downloading “{rp}”... ", end="")
+        code = codes.get(BASEURL + rp, cp.returncode)
+        # curl stores the file under its base name in PKGDIR.
+        path = PKGDIR + os.path.basename(rp)
+        try:
+            mode = os.stat(path).st_mode
+        except FileNotFoundError:
+            code = code or 1
+        if code != 0:
+            print(f"{RED}failed, code {code}.{RESET}")
+            continue
         # Make packages readable for everyone.
-        os.chmod(PKGDIR[:-4] + repopath, 0o0644)
+        if mode & 0o777 != 0o644:
+            os.chmod(path, 0o644)
         print(f"{GREEN}done.{RESET}")
 
 
-def check_running():
-    """Check if an important command is already running. If so, exit."""
-    ourpid = str(os.getpid())
-    psdata = sp.check_output(["ps", "--libxo=json"]).decode("utf-8")
-    procs = json.loads(psdata)["process-information"]["process"]
-    del psdata
-    for pid, terminal_name, state, cpu_time, command in procs:
-        if pid == ourpid:
-            continue
-        if "repotool" not in command:
-            continue
-        if any(j in command for j in ("upgrade", "refresh", "delete")):
-            print(f"{RED}Upgrade, refresh or delete in progress.{RESET}", end=" ")
-            print(f"Process {pid}, terminal {terminal_name}; exiting.")
-            sys.exit(3)
+def check_running(cmd):
+    """
+    Check if an important command is already running. If so, exit.
+    Commands that change the repo keep an exclusive lock on LOCKFILE while
+    they run. Other commands only check that there is no such lock.
+
+    Arguments:
+        cmd (str): Name of the command that is about to run.
+
+    Returns: the open lock file. Closing it releases the lock.
+    """
+    lockfile = open(LOCKFILE, "a+")
+    exclusive = cmd in ("refresh", "delete")
+    mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    try:
+        fcntl.flock(lockfile, mode | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lockfile.seek(0)
+        pid = lockfile.read().strip()
+        print(f"{RED}Refresh or delete in progress.{RESET}", end=" ")
+        print(f"Process {pid}; exiting.")
+        sys.exit(3)
+    if exclusive:
+        lockfile.truncate(0)
+        lockfile.write(str(os.getpid()))
+        lockfile.flush()
+    else:
+        fcntl.flock(lockfile, fcntl.LOCK_UN)
+    return lockfile
 
 
 def get_manifest(repopath):
@@ -506,5 +699,51 @@ def get_manifest(repopath):
     return json.loads(rv.stdout)
 
 
+# Supported commands.
+# Maps the name of a command to the function that carries it out, the names of
+# the arguments it takes after the cursor, and its help text.
+# This comes after the functions, so that it can refer to them.
+commands = {
+    "list": (cmd_list, ("start",), "show all available packages"),
+    "show": (
+        cmd_show,
+        ("start", "pkgname"),
+        "show what would be downloaded for a given package name",
+    ),
+    "contains": (
+        cmd_contains,
+        ("start", "pkgname"),
+        "print the names of packages that contain the given string",
+    ),
+    "get": (
+        cmd_get,
+        ("start", "pkgname"),
+        "download the given package, plus any required dependencies",
+    ),
+    "delete": (
+        cmd_delete,
+        ("start", "pkgname"),
+        "delete a package if it is unused, plus any unused dependencies",
+    ),
+    "info": (cmd_info, ("start", "pkgname"), "show information about a named package"),
+    "leaves": (cmd_leaves, ("start",), "show all packages that are not depended on"),
+    "refresh": (
+        cmd_refresh,
+        ("start",),
+        "for every package, check and update the requirements",
+    ),
+    "unused": (
+        cmd_unused,
+        ("start",),
+        "show packages in the repo that are not installed",
+    ),
+    "check": (cmd_check, ("start",), "for every package, check size and checksum"),
+    "repl": (
+        cmd_repl,
+        (),
+        "read and run commands from standard input, reusing the database",
+    ),
+}
+
 if __name__ == "__main__":
     main()